@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import socket
+import sys
+from argparse import ArgumentParser
+
+DEFAULT_SOCKET = '/run/huion-tablet-driver.sock'
+
+
+# -----------------------------------------------------------------------------
+def main():
+    """ Sends a command to a running huion-tablet-driver.py
+        through its control socket, and prints the reply.
+    """
+    parser = ArgumentParser(
+        description='Control a running huion-tablet-driver.py',
+        epilog='commands: menu [<menu>], monitor [<monitor setup>], '
+            'reverse [on|off|toggle], stats, help')
+    parser.add_argument('-s', '--socket', default=DEFAULT_SOCKET,
+        help='path of the control socket (default: %(default)s)')
+    parser.add_argument('command', nargs='+',
+        help='the command and its arguments')
+    args = parser.parse_args()
+
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.socket)
+    except OSError as e:
+        print("Error, could not connect to {}: {}".format(args.socket, e),
+            file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        sock.sendall((' '.join(args.command) + '\n').encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass # the driver refused the connection, its reply says why
+
+    reply = b''
+    while True:
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        reply += chunk
+    sock.close()
+
+    reply = reply.decode('utf-8').strip()
+    print(reply)
+
+    if not reply.startswith('OK'):
+        sys.exit(1)
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    main()
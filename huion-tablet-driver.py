@@ -3,16 +3,42 @@
 import usb.core, usb.util
 import sys
 import os.path
+import stat
 import platform
+import asyncio
+import threading
+import socket
+import struct
+import pwd
+import grp
+import queue
 from evdev import UInput, ecodes, AbsInfo, InputDevice, list_devices
 import subprocess as sp
 import math
+import re
+import errno
 import numexpr
 from configparser import ConfigParser, ExtendedInterpolation
-from time import gmtime, strftime
+from time import gmtime, strftime, monotonic
 
 MENU = {}
 
+# the only USB id the driver knew about before the tablet registry
+DEFAULT_USB_ID = (0x256c, 0x006e)
+
+# missing from older python-evdev versions
+REL_WHEEL_HI_RES = getattr(ecodes, 'REL_WHEEL_HI_RES', 0x0b)
+WHEEL_HI_RES_DETENT = 120
+
+# string descriptors read by uclogic-probe. Reading them is what switches
+# the tablet into its full reporting mode
+UCLOGIC_STRINGS = (0x64, 0x79, 0x7b, 0xc8, 0xc9, 0xca)
+UCLOGIC_FIRMWARE = 0xc9
+
+# milliseconds main_loop() may wait for the tablet before running the
+# pending control socket commands
+CONTROL_POLL_TIMEOUT = 100
+
 
 # -----------------------------------------------------------------------------
 class main():
@@ -23,32 +49,65 @@ class main():
     dev = None
     endpoint = None
     vpen = None
+    vwheel = None
+    config = None
+    current_tablet = None
+    usb_strings = {}
     current_menu = None
+    timers = None
+    gestures = None
+    scroll = None
+    commands = queue.Queue() # from the control socket, run by main_loop()
+    stats = {'started':0, 'reports':0, 'pen':0, 'buttons':0, 'scrollbar':0,
+             'shortcuts':0, 'menu_switches':0, 'usb_errors':0}
 
     def run():
+        load_config()
         find_usb_device()
         read_config()
         prepare_driver()
         setup_driver()
         calibrate()
         multi_monitor()
+        control_socket()
         main_loop()
 
 
 # -----------------------------------------------------------------------------
 def find_usb_device():
-    """
+    """ Enumerates the USB devices once, and picks the tablet section
+        from config.ini that matches, unless current_tablet is set.
     """
     sys.stdout.write("Finding USB device. . . ")
 
-    main.dev = usb.core.find(idVendor=0x256c, idProduct=0x006e)
+    registry = tablet_registry(main.config)
+    current_tablet = main.config.get('config', 'current_tablet'
+        ).split("#",1)[0].strip('[]').strip()
+
+    if current_tablet == 'auto':
+        usb_ids = set(entry['usb_id'] for entry in registry.values())
+    elif current_tablet in registry:
+        usb_ids = {registry[current_tablet]['usb_id']}
+    else:
+        usb_ids = {DEFAULT_USB_ID}
 
-    if not main.dev:
+    devices = list(usb.core.find(find_all=True, custom_match=lambda d:
+        (d.idVendor, d.idProduct) in usb_ids))
+
+    if not devices:
         print("Error, Could not find device, maybe already opened?",
             file=sys.stderr)
         sys.exit(1)
+
+    if current_tablet == 'auto':
+        main.dev, main.current_tablet = detect_tablet(registry, devices)
     else:
-        print("Done!")
+        main.dev, main.current_tablet = devices[0], current_tablet
+        main.usb_strings = read_usb_strings(main.dev)
+
+    print("Done!")
+    if current_tablet == 'auto':
+        print("\tDetected [{}]".format(main.current_tablet))
 
     for cfg in main.dev:
         for i in cfg:
@@ -63,6 +122,111 @@ def find_usb_device():
     main.endpoint = main.dev[0][(0,0)][0]
 
 
+# -----------------------------------------------------------------------------
+def tablet_registry(config):
+    """ Maps the tablet sections that have a usb_id to the USB id and the
+        (optional) string descriptors that identify them.
+    """
+    registry = {}
+
+    for section in config.sections():
+        if not config.has_option(section, 'usb_id'):
+            continue
+        try:
+            vid, pid = config.get(section, 'usb_id').split("#",1)[0].strip().split(':')
+            registry[section] = {'usb_id': (int(vid, 16), int(pid, 16))}
+        except ValueError:
+            print("\nWarning, ignoring the bad usb_id of [{}]".format(section),
+                file=sys.stderr)
+            continue
+
+        for key in ('manufacturer', 'product', 'firmware'):
+            if config.has_option(section, 'usb_' + key):
+                registry[section][key] = config.get(section,
+                    'usb_' + key).split("#",1)[0].strip()
+
+    return registry
+
+
+# -----------------------------------------------------------------------------
+def read_usb_strings(dev):
+    """ Reads the string descriptors used for identifying a tablet.
+        The ones the device doesn't have are left as empty strings.
+    """
+    strings = {}
+
+    for key, read in (
+            ('manufacturer', lambda: dev.manufacturer),
+            ('product', lambda: dev.product),
+            ('serial', lambda: dev.serial_number),
+            ('firmware', lambda: usb.util.get_string(dev, UCLOGIC_FIRMWARE))):
+        try:
+            strings[key] = (read() or "").strip()
+        except (usb.core.USBError, ValueError, NotImplementedError):
+            strings[key] = ""
+
+    return strings
+
+
+# -----------------------------------------------------------------------------
+def detect_tablet(registry, devices):
+    """ Returns the device and the tablet section that matches it best.
+        A section matches when its USB id does, and each of its strings
+        is found in the corresponding string descriptor of the device.
+        When several match equally well, fallback_tablet is picked.
+    """
+    matches = []
+
+    for dev in devices:
+        strings = read_usb_strings(dev)
+        for section, entry in registry.items():
+            if entry['usb_id'] != (dev.idVendor, dev.idProduct):
+                continue
+            keys = [key for key in entry if key != 'usb_id']
+            if all(entry[key].lower() in strings[key].lower() for key in keys):
+                matches.append((len(keys), section, dev, strings))
+
+    best = [m for m in matches if m[0] == max(m[0] for m in matches)]
+
+    fallback = main.config.get('config', 'fallback_tablet', fallback=''
+        ).split("#",1)[0].strip('[]').strip()
+    if len(best) > 1 and fallback in [m[1] for m in best]:
+        print("\nWarning, {} tablet sections match, using fallback_tablet".format(
+            len(best)), file=sys.stderr)
+        best = [m for m in best if m[1] == fallback]
+
+    if len(best) != 1:
+        print("Error, Could not tell which tablet this is", file=sys.stderr)
+        if best:
+            print("Matching sections: {}".format(
+                ", ".join("[{}]".format(m[1]) for m in best)), file=sys.stderr)
+            print("Device strings: {}".format(best[0][3]), file=sys.stderr)
+        print("Set current_tablet or fallback_tablet in config.ini, or add a"
+            " usb_product or usb_firmware option to the right tablet section",
+            file=sys.stderr)
+        sys.exit(1)
+
+    main.usb_strings = best[0][3]
+    return best[0][2], best[0][1]
+
+
+# -----------------------------------------------------------------------------
+def uclogic_cache_file():
+    """ Returns the file caching the uclogic-probe output for the device,
+        or None if caching is disabled or the device can't be told apart.
+    """
+    if not main.settings['uclogic_cache']:
+        return None
+
+    device_id = main.usb_strings.get('serial') or main.usb_strings.get('firmware')
+    if not device_id:
+        return None
+
+    return os.path.join(main.settings['uclogic_cache'],
+        "{:04x}-{:04x}-{}.txt".format(main.dev.idVendor, main.dev.idProduct,
+            re.sub(r'[^\w.-]', '_', device_id)))
+
+
 # -----------------------------------------------------------------------------
 def prepare_driver():
     """
@@ -85,18 +249,43 @@ def prepare_driver():
 
     sp.run('modprobe "{}"'.format(module_new), shell=True)
 
-    cmd='"{}/uclogic-probe" "{}" "{}" | "{}/uclogic-decode"'.format(
-        main.settings['uclogic_bins'], main.dev.bus, main.dev.address,
-        main.settings['uclogic_bins'])
-    try:
-        uc_str = sp.run(cmd, shell=True, check=True, stdout=sp.PIPE)
-    except sp.CalledProcessError as e:
-        run_error(e, cmd)
+    cache_file = uclogic_cache_file()
+    cache_hit = bool(cache_file) and os.path.exists(cache_file)
+
+    if cache_hit:
+        # do what uclogic-probe would, without running it
+        for index in UCLOGIC_STRINGS:
+            try:
+                usb.util.get_string(main.dev, index)
+            except (usb.core.USBError, ValueError, NotImplementedError):
+                pass
+        with open(cache_file) as f:
+            uc_str = f.read()
+    else:
+        cmd='"{}/uclogic-probe" "{}" "{}" | "{}/uclogic-decode"'.format(
+            main.settings['uclogic_bins'], main.dev.bus, main.dev.address,
+            main.settings['uclogic_bins'])
+        try:
+            uc_str = sp.run(cmd, shell=True, check=True,
+                stdout=sp.PIPE).stdout.decode("utf-8")
+        except sp.CalledProcessError as e:
+            run_error(e, cmd)
+
+        if cache_file:
+            try:
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                with open(cache_file, 'w') as f:
+                    f.write(uc_str)
+            except OSError as e:
+                print("\nWarning, could not cache the uclogic output: {}".format(e),
+                    file=sys.stderr)
 
     print("Done!")
 
     if main.settings['debug_mode']:
-        print('-'*80+'\n'+ uc_str.stdout.decode("utf-8") +'-'*80)
+        if cache_hit:
+            print("(uclogic output read from {})".format(cache_file))
+        print('-'*80+'\n'+ uc_str +'-'*80)
 
 
 # -----------------------------------------------------------------------------
@@ -120,6 +309,14 @@ def setup_driver():
     }
     main.vpen = UInput(events=cap_pen, name=main.settings['pen_device_name'], version=0x3)
 
+    # mouse wheel with high resolution scrolling, for the scrollbar
+    if main.settings['enable_scrollbar'] and main.settings['scrollbar_output'] == 'wheel':
+        cap_wheel = {
+            ecodes.EV_REL: [ecodes.REL_WHEEL, REL_WHEEL_HI_RES],
+        }
+        main.vwheel = UInput(events=cap_wheel,
+            name=main.settings['pen_device_name'] + ' Wheel', version=0x3)
+
     print("Done!")
 
     # INFO ---------------------
@@ -141,6 +338,8 @@ def setup_driver():
         if main.settings['scrollbar_reverse']:
             print("\t\tReversed:         {}".format(
             main.settings['scrollbar_reverse']))
+        print("\t\tOutput:           {}".format(
+            main.settings['scrollbar_output']))
     else:
         print("\tScrollbar                 disabled ({})".format(
            main.settings['scrollbar']))
@@ -293,7 +492,11 @@ def main_loop():
     if main.current_menu:
         switch_menu(main.current_menu)
 
-    SCROLL_VAL_PREV=0
+    main.stats['started'] = monotonic()
+
+    main.timers = TimerWheel()
+    main.gestures = ButtonGestures(main.timers)
+    main.scroll = ScrollEngine(main.timers)
 
     if main.settings['debug_mode']:
         HOVER_PREV = False
@@ -301,8 +504,18 @@ def main_loop():
             print("Please slowly and briefly touch the LEFT UP corner of your tablet:");
 
     while True:
+        # pending gestures shorten the read timeout, so they can expire
+        main.timers.advance(monotonic())
+        run_control_commands()
+        read_timeout = main.timers.timeout(monotonic())
+        if main.settings['enable_control_socket']:
+            read_timeout = min(read_timeout or CONTROL_POLL_TIMEOUT,
+                CONTROL_POLL_TIMEOUT)
+
         try:
-            data = main.dev.read(main.endpoint.bEndpointAddress, main.endpoint.wMaxPacketSize)
+            data = main.dev.read(main.endpoint.bEndpointAddress,
+                main.endpoint.wMaxPacketSize, read_timeout)
+            main.stats['reports'] += 1
 
             # DATA INTERPRETATION:
             # source: https://github.com/andresm/digimend-kernel-drivers/commit/b7c8b33c0392e2a5e4e448f901e3dfc206d346a6
@@ -369,41 +582,25 @@ def main_loop():
             # BUTTON EVENT
 
             if is_buttonbar and main.settings['enable_buttons']:
-                # get the button value in power of two (1, 2, 4, 16, 32...)
-                BUTTON_VAL = (data[5] << 8) + data[4]
+                main.stats['buttons'] += 1
+                # get the buttons held as a bitmask (1, 2, 4, 16, 32...)
+                BUTTON_VAL = (data[5] << 8) + data[4] # 0 means release
 
-                if BUTTON_VAL > 0: # 0 means release
-                    # convert to the exponent (0, 1, 2, 3, 4...)
-                    BUTTON_VAL = int(math.log(BUTTON_VAL, 2))
-                    if main.current_menu:
-                        do_shortcut("button", MENU[main.current_menu][BUTTON_VAL])
+                if main.current_menu:
+                    main.gestures.update(BUTTON_VAL, monotonic())
 
             # SCROLLBAR EVENT
 
             elif is_scrollbar and main.settings['enable_scrollbar']:
-                SCROLL_VAL = data[5]
-
-                if SCROLL_VAL > 0: # 0 means release
-                    if SCROLL_VAL_PREV == 0:
-                        SCROLL_VAL_PREV=SCROLL_VAL
-
-                    if main.current_menu:
-                        if main.settings['scrollbar_reverse']:
-                            if SCROLL_VAL > SCROLL_VAL_PREV:
-                                do_shortcut("scrollbar", MENU[main.current_menu]['scroll_up'])
-                            elif SCROLL_VAL < SCROLL_VAL_PREV:
-                                do_shortcut("scrollbar", MENU[main.current_menu]['scroll_down'])
-                        else:
-                            if SCROLL_VAL < SCROLL_VAL_PREV:
-                                do_shortcut("scrollbar", MENU[main.current_menu]['scroll_up'])
-                            elif SCROLL_VAL > SCROLL_VAL_PREV:
-                                do_shortcut("scrollbar", MENU[main.current_menu]['scroll_down'])
-
-                SCROLL_VAL_PREV = SCROLL_VAL
+                main.stats['scrollbar'] += 1
+                SCROLL_VAL = data[5] # 0 means release
+
+                main.scroll.update(SCROLL_VAL, monotonic())
 
             # TOUCH EVENT
 
             else:
+                main.stats['pen'] += 1
                 # bitwise operations: n<<16 == n*65536 and n<<8 == n*256
                 try:
                     X = (data[8]<<16) + (data[3]<<8) + data[2]
@@ -446,44 +643,335 @@ def main_loop():
 
         except usb.core.USBError as e:
             data = None
-            if e.args == ('Operation timed out',):
-                print(e, file=sys.stderr)
+            # a timeout just means the tablet had nothing to say,
+            # or that the timer wheel or the control socket need a turn
+            if (e.errno == errno.ETIMEDOUT
+                    or e.args == ('Operation timed out',)):
                 continue
+            main.stats['usb_errors'] += 1
+
+
+# -----------------------------------------------------------------------------
+class TimerWheel():
+    """ A hashed timer wheel, serviced by main_loop() between reads.
+        Timers are rounded up to the next tick, and the ones due more than
+        a whole turn away stay in their slot until their tick comes.
+    """
+
+    def __init__(self, tick=0.01, slots=128):
+        self.tick = tick
+        self.slots = [[] for n in range(slots)]
+        self.current = int(monotonic() / tick) # last tick serviced
+        self.pending = 0
+
+    def schedule(self, now, delay, callback, *args):
+        """ Calls callback(*args) after delay seconds.
+            Returns the timer, which can be cancelled.
+        """
+        due = max(int(math.ceil((now + delay) / self.tick)), self.current + 1)
+        timer = [due, callback, args]
+        self.slots[due % len(self.slots)].append(timer)
+        self.pending += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer and timer[1]:
+            timer[1] = None # dropped when its slot comes around
+            self.pending -= 1
+
+    def advance(self, now):
+        """ Fires the timers that are due by now.
+        """
+        now_tick = int(now / self.tick)
+
+        while self.pending and self.current < now_tick:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            due = [timer for timer in slot if timer[0] <= self.current]
+            slot[:] = [timer for timer in slot if timer[0] > self.current]
+
+            for timer in due:
+                callback = timer[1]
+                if callback:
+                    self.cancel(timer)
+                    callback(*timer[2])
+
+        self.current = max(self.current, now_tick)
+
+    def timeout(self, now):
+        """ Returns the milliseconds until the earliest pending timer is due,
+            for the USB read, or None when no timers are pending.
+        """
+        if not self.pending:
+            return None
+        due = min(timer[0] for slot in self.slots for timer in slot if timer[1])
+        return max(1, int(math.ceil((due * self.tick - now) * 1000)))
 
 
 # -----------------------------------------------------------------------------
-def do_shortcut(title, sequence):
+class ButtonGestures():
+    """ Resolves the buttons bitmask into taps, long presses (b3_long),
+        double taps (b3_double) and chords (b1+b2).
+
+        Buttons without gestures in the current menu fire on press, as before.
+        The rest wait for the release, or for their timer to expire. Timers
+        keep the actions of the menu they were started in.
+    """
+
+    def __init__(self, timers):
+        self.timers = timers
+        self.mask = 0  # buttons held
+        self.peak = 0  # buttons held since everything was last released
+        self.fired = 0 # buttons whose action was already done
+        self.long_timer = None
+        self.tap_timer = None
+        self.tap_button = None
+        self.tap_actions = None # single and double tap, of the menu tapped
+
+    def update(self, mask, now):
+        pressed = mask & ~self.mask
+        self.mask = mask
+
+        if pressed:
+            # another button ends the wait for a double tap
+            if self.tap_timer and pressed != 1 << self.tap_button:
+                self.timers.cancel(self.tap_timer)
+                self.on_tap(self.tap_actions[0])
+
+            if self.peak:
+                self.timers.cancel(self.long_timer) # it's a chord
+            elif pressed & (pressed - 1) == 0:
+                n = pressed.bit_length() - 1
+                if gesture(n, 'long') and not self.tap_timer:
+                    self.long_timer = self.timers.schedule(now,
+                        main.settings['long_press_time'], self.on_long, n,
+                        gesture(n, 'long'))
+            self.peak |= pressed
+
+            for n in buttons(pressed):
+                if not deferred(n):
+                    self.fired |= 1 << n
+                    do_shortcut("button", MENU[main.current_menu][n])
+
+        if not mask and self.peak:
+            self.release(now)
+
+    def release(self, now):
+        peak, fired = self.peak, self.fired
+        self.peak = self.fired = 0
+        self.timers.cancel(self.long_timer)
+
+        if peak & (peak - 1): # more than one button
+            chord = '+'.join('b{}'.format(n) for n in buttons(peak))
+            if gesture(chord):
+                do_shortcut("button", gesture(chord))
+                return
+            for n in buttons(peak & ~fired):
+                do_shortcut("button", MENU[main.current_menu][n])
+
+        elif not peak & fired:
+            n = peak.bit_length() - 1
+            if not gesture(n, 'double'):
+                do_shortcut("button", MENU[main.current_menu][n])
+            elif self.tap_timer:
+                self.timers.cancel(self.tap_timer)
+                self.tap_timer = None
+                do_shortcut("button", self.tap_actions[1])
+            else:
+                self.tap_button = n
+                self.tap_actions = (MENU[main.current_menu][n], gesture(n, 'double'))
+                self.tap_timer = self.timers.schedule(now,
+                    main.settings['double_tap_time'], self.on_tap,
+                    self.tap_actions[0])
+
+    def on_long(self, n, sequence):
+        if self.mask == self.peak == 1 << n:
+            self.fired |= 1 << n
+            do_shortcut("button", sequence)
+
+    def on_tap(self, sequence):
+        self.tap_timer = None
+        do_shortcut("button", sequence)
+
+
+# -----------------------------------------------------------------------------
+class ScrollEngine():
+    """ Turns the scrollbar positions into scroll steps, proportionate to
+        the swipe: the faster it goes, the more steps each position is worth.
+
+        The steps are either batched into a single repeated shortcut, or
+        written as high resolution wheel events to the virtual wheel.
+    """
+
+    def __init__(self, timers):
+        self.timers = timers
+        self.prev = 0         # last position, 0 when released
+        self.prev_time = 0
+        self.speed = 0        # positions per second, smoothed
+        self.remainder = 0.0  # fraction of a step not yet emitted
+        self.wheel = 0        # high resolution units not yet a detent
+        self.steps = 0        # batched steps, positive for scrolling up
+        self.flush_timer = None
+        self.process = None   # xdotool running the last batch
+
+    def update(self, pos, now):
+        if not pos:
+            self.prev = self.speed = 0
+            self.remainder = 0.0
+            return
+
+        if not self.prev:
+            self.prev, self.prev_time = pos, now
+            return
+
+        delta, dt = pos - self.prev, now - self.prev_time
+        self.prev, self.prev_time = pos, now
+        if not delta:
+            return
+
+        speed = abs(delta) / max(dt, 0.001)
+        self.speed = self.speed and (self.speed + speed) / 2 or speed
+
+        # going down the scrollbar scrolls up, unless reversed
+        amount = -delta * main.settings['scroll_sensitivity'] * self.gain()
+        if main.settings['scrollbar_reverse']:
+            amount = -amount
+
+        if main.vwheel:
+            self.write_wheel(amount)
+        else:
+            self.remainder += amount
+            steps = int(self.remainder)
+            self.remainder -= steps
+            self.steps += steps
+            if self.steps and not self.flush_timer:
+                self.flush_timer = self.timers.schedule(now,
+                    main.settings['scroll_batch_time'], self.flush)
+
+    def gain(self):
+        """ The acceleration curve: 1 up to scroll_threshold, and then
+            growing with the speed, up to scroll_max_gain.
+        """
+        if self.speed <= main.settings['scroll_threshold']:
+            return 1
+        return min(main.settings['scroll_max_gain'],
+            (self.speed / main.settings['scroll_threshold'])
+                ** main.settings['scroll_acceleration'])
+
+    def write_wheel(self, amount):
+        self.remainder += amount * WHEEL_HI_RES_DETENT
+        hi_res = int(self.remainder)
+        if not hi_res:
+            return
+        self.remainder -= hi_res
+
+        # the plain wheel gets a detent for every 120 high resolution units
+        self.wheel += hi_res
+        detents = int(self.wheel / WHEEL_HI_RES_DETENT)
+        self.wheel -= detents * WHEEL_HI_RES_DETENT
+
+        main.vwheel.write(ecodes.EV_REL, REL_WHEEL_HI_RES, hi_res)
+        if detents:
+            main.vwheel.write(ecodes.EV_REL, ecodes.REL_WHEEL, detents)
+        main.vwheel.syn()
+
+    def flush(self):
+        self.flush_timer = None
+
+        # one batch at a time, the next one waits while it keeps growing
+        if self.process and self.process.poll() is None:
+            self.flush_timer = self.timers.schedule(monotonic(),
+                main.settings['scroll_batch_time'], self.flush)
+            return
+
+        steps, self.steps = self.steps, 0
+        if not main.current_menu or not steps:
+            return
+        if steps > 0:
+            self.process = do_shortcut("scrollbar",
+                MENU[main.current_menu]['scroll_up'], steps)
+        else:
+            self.process = do_shortcut("scrollbar",
+                MENU[main.current_menu]['scroll_down'], -steps)
+
+
+# -----------------------------------------------------------------------------
+def buttons(mask):
+    """ Returns the numbers of the buttons in the bitmask.
+    """
+    return [n for n in range(mask.bit_length()) if mask & 1 << n]
+
+
+# -----------------------------------------------------------------------------
+def gesture(button, kind=None):
+    """ Returns the action bound to a gesture in the current menu,
+        e.g. gesture(3, 'long') or gesture('b1+b2').
+    """
+    key = kind and 'b{}_{}'.format(button, kind) or button
+    return MENU[main.current_menu]['gestures'].get(key, "")
+
+
+# -----------------------------------------------------------------------------
+def deferred(n):
+    """ Whether button n has gestures in the current menu, and so
+        can't fire its action as soon as it's pressed.
+    """
+    btn = 'b{}'.format(n)
+    for key, sequence in MENU[main.current_menu]['gestures'].items():
+        if sequence and (key.startswith(btn + '_') or btn in key.split('+')):
+            return True
+    return False
+
+
+# -----------------------------------------------------------------------------
+def do_shortcut(title, sequence, repeat=1):
     """ Interprets whether the shortcut is a keypress or a menu link
         and triggers the appropiate action in either case.
+        Returns the xdotool process when it's left running (see keypress).
     """
     # empty shortcut
     if sequence == "":
-        pass
+        return
+
+    main.stats['shortcuts'] += 1
 
     # is a menu link
-    elif sequence.startswith('[') and sequence.endswith(']'):
+    if sequence.startswith('[') and sequence.endswith(']'):
         switch_menu(sequence.strip('[]'))
 
     # is a keyboard shortcut
     else:
-        keypress(title, sequence)
+        return keypress(title, sequence, repeat)
 
 
 # -----------------------------------------------------------------------------
-def keypress(title, sequence):
-    """
+def keypress(title, sequence, repeat=1):
+    """ Runs the xdotool sequence, repeat times. Repeated sequences take
+        a while, so they are left running, and their process is returned.
     """
     if main.settings['enable_notifications']:
         if (title == 'scrollbar' and main.settings['scrollbar_notifications']) \
             or (title != 'scrollbar' and main.settings['buttons_notifications']):
 
-            cmd='notify-send "{}" "{}"'.format(title, sequence)
+            cmd='notify-send "{}" "{}{}"'.format(title, sequence,
+                repeat > 1 and " (x{})".format(repeat) or "")
             try:
                 sp.run(cmd, shell=True, check=True)
             except sp.CalledProcessError as e:
                 run_error(e, cmd)
 
-    cmd="xdotool {}".format(sequence)
+    command = sequence.split(None, 1)
+    if repeat > 1 and command[0] in ('key', 'click') and len(command) > 1:
+        # a single xdotool call for all of them
+        cmd="xdotool {} --repeat {} {}".format(command[0], repeat, command[1])
+    else:
+        cmd="xdotool {}".format(sequence)
+        if repeat > 1:
+            cmd = "; ".join([cmd.split("#",1)[0]] * repeat)
+
+    if repeat > 1:
+        return sp.Popen(cmd, shell=True)
+
     try:
         sp.run(cmd, shell=True, check=True)
     except sp.CalledProcessError as e:
@@ -498,12 +986,15 @@ def switch_menu(new_menu):
         return
 
     main.current_menu = new_menu
+    main.stats['menu_switches'] += 1
 
     # print the menu
     menu_title = MENU[new_menu]['title']
     menu_text = ""
     for n in range(0, main.settings['buttons']):
         menu_text += "\nbutton {} = {}".format(n, MENU[main.current_menu][n])
+    for key in sorted(MENU[main.current_menu]['gestures']):
+        menu_text += "\n{} = {}".format(key, MENU[main.current_menu]['gestures'][key])
 
     print(menu_title + menu_text)
 
@@ -515,6 +1006,188 @@ def switch_menu(new_menu):
             run_error(e, cmd)
 
 
+# -----------------------------------------------------------------------------
+def control_socket():
+    """ Opens the control socket and serves it from an asyncio event loop
+        running in its own thread, so main_loop() keeps reading the tablet.
+        The commands themselves are run by main_loop().
+        See huion-tablet-ctl.py for a client.
+    """
+    if not main.settings['enable_control_socket']:
+        return
+
+    sys.stdout.write("Opening control socket. . . ")
+
+    path = main.settings['control_socket']
+    try:
+        is_socket = stat.S_ISSOCK(os.lstat(path).st_mode)
+    except FileNotFoundError:
+        is_socket = None
+    if is_socket: # left over from a previous run
+        os.remove(path)
+    elif is_socket is not None:
+        print("Error, {} exists and is not a socket".format(path), file=sys.stderr)
+        return
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asyncio.start_unix_server(control_client, path=path))
+    except OSError as e:
+        print("Error, could not open {}: {}".format(path, e), file=sys.stderr)
+        return
+
+    # the driver usually runs as root, but the clients run as the desktop
+    # user. control_client() checks who is connecting as well
+    gid = main.settings['control_socket_gid']
+    os.chown(path, main.settings['control_socket_owner'], -1 if gid is None else gid)
+    os.chmod(path, 0o660)
+
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    print("Done!")
+    print("\tListening on {} (for uids {}{})".format(path,
+        ", ".join(str(uid) for uid in sorted(main.settings['control_socket_uids'])),
+        gid is not None and " and gid {}".format(gid) or ""))
+
+
+# -----------------------------------------------------------------------------
+def control_allowed(uid, gid):
+    """ Whether a control socket client can run commands: root, the user
+        running sudo, and the members of control_socket_group.
+    """
+    if uid in main.settings['control_socket_uids']:
+        return True
+
+    group = main.settings['control_socket_gid']
+    if group is None:
+        return False
+    if gid == group:
+        return True
+    try:
+        return pwd.getpwuid(uid).pw_name in grp.getgrgid(group).gr_mem
+    except KeyError:
+        return False
+
+
+# -----------------------------------------------------------------------------
+async def control_client(reader, writer):
+    """ Serves a control socket connection. It reads one command per line,
+        and answers each one with a reply terminated by an empty line.
+    """
+    sock = writer.get_extra_info('socket')
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+        struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', creds)
+    allowed = control_allowed(uid, gid)
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+
+        args = line.decode('utf-8', 'replace').split()
+        if not args:
+            continue
+
+        if allowed:
+            # main_loop() runs it, as it owns the menus and the gestures
+            loop = asyncio.get_event_loop()
+            reply = loop.create_future()
+            main.commands.put((args[0].lower(), args[1:], loop, reply))
+            reply = await reply
+        else:
+            reply = "ERROR uid {} is not allowed".format(uid)
+
+        writer.write((reply + "\n\n").encode('utf-8'))
+        await writer.drain()
+
+    writer.close()
+
+
+# -----------------------------------------------------------------------------
+def run_control_commands():
+    """ Runs the commands queued by control_client(), and hands the replies
+        back to the control socket thread.
+    """
+    while not main.commands.empty():
+        cmd, args, loop, reply = main.commands.get()
+
+        try:
+            result = control_command(cmd, args)
+        except SystemExit: # run_error() must not take the driver down
+            result = "ERROR the command failed, see the driver output"
+        except Exception as e:
+            result = "ERROR {}: {}".format(type(e).__name__, e)
+
+        def set_reply(reply=reply, result=result):
+            if not reply.done(): # the client may be gone
+                reply.set_result(result)
+        loop.call_soon_threadsafe(set_reply)
+
+
+# -----------------------------------------------------------------------------
+def control_command(cmd, args):
+    """ Runs a control socket command and returns the reply,
+        which starts with either OK or ERROR.
+    """
+
+    # switch the current menu
+    if cmd == 'menu':
+        if not args:
+            return "OK [{}]".format(main.current_menu)
+        new_menu = args[0].strip('[]')
+        if not main.settings['enable_buttons']:
+            return "ERROR buttons are disabled"
+        if new_menu not in MENU:
+            return "ERROR unknown menu [{}]".format(new_menu)
+        switch_menu(new_menu)
+        return "OK [{}]".format(main.current_menu)
+
+    # change the monitor setup
+    elif cmd == 'monitor':
+        if not args:
+            return "OK {}".format(main.settings.get('monitor_setup'))
+        if not main.settings['screen']:
+            return "ERROR the tablet has no screen"
+        if not read_monitor_setup(main.config, args[0]):
+            return "ERROR unknown or incomplete monitor setup {}".format(args[0])
+        main.settings['enable_multi_monitor'] = True
+        multi_monitor()
+        return "OK {}".format(main.settings['monitor_setup'])
+
+    # toggle the scrollbar reversal
+    elif cmd == 'reverse':
+        value = args[0].lower() if args else 'toggle'
+        if value == 'toggle':
+            main.settings['scrollbar_reverse'] = not main.settings['scrollbar_reverse']
+        elif value in ('on', 'true', '1'):
+            main.settings['scrollbar_reverse'] = True
+        elif value in ('off', 'false', '0'):
+            main.settings['scrollbar_reverse'] = False
+        else:
+            return "ERROR expected on, off or toggle"
+        return "OK {}".format(main.settings['scrollbar_reverse'] and 'on' or 'off')
+
+    # dump the live counters
+    elif cmd == 'stats':
+        reply = "OK"
+        reply += "\nuptime {:.1f}".format(monotonic() - main.stats['started'])
+        for key in sorted(main.stats):
+            if key != 'started':
+                reply += "\n{} {}".format(key, main.stats[key])
+        reply += "\nmenu [{}]".format(main.current_menu)
+        reply += "\nmonitor {}".format(main.settings.get('monitor_setup'))
+        reply += "\nreverse {}".format(
+            main.settings['scrollbar_reverse'] and 'on' or 'off')
+        return reply
+
+    elif cmd == 'help':
+        return ("OK\nmenu [<menu>]\nmonitor [<monitor setup>]"
+            "\nreverse [on|off|toggle]\nstats")
+
+    return "ERROR unknown command {}, try help".format(cmd)
+
+
 # -----------------------------------------------------------------------------
 def run_error(error, command, exit=True):
     """
@@ -526,6 +1199,18 @@ def run_error(error, command, exit=True):
         sys.exit(1)
 
 
+# -----------------------------------------------------------------------------
+def load_config():
+    """ Loads config.ini, which is needed for finding the USB device.
+    """
+    if os.path.exists('config.ini'):
+        main.config = ConfigParser(interpolation=ExtendedInterpolation())
+        main.config.read('config.ini')
+    else:
+        print("ERROR: Couldn't locate config.ini")
+        sys.exit(2)
+
+
 # -----------------------------------------------------------------------------
 def read_config():
     """
@@ -533,17 +1218,12 @@ def read_config():
 
     sys.stdout.write("Reading configuration. . . ")
 
-    if os.path.exists('config.ini'):
-        config = ConfigParser(interpolation=ExtendedInterpolation())
-        config.read('config.ini')
-    else:
-        print("ERROR: Couldn't locate config.ini")
-        sys.exit(2)
+    config = main.config
 
 
     # tablet info
 
-    current_tablet = config.get('config', 'current_tablet').split("#",1)[0].strip('[]').strip()
+    current_tablet = main.current_tablet
 
     try:
         main.settings['model_name'] = config.get(current_tablet, 'model_name')
@@ -620,6 +1300,18 @@ def read_config():
     except:
         main.settings['pen_buttons_reverse'] = False
 
+    # gestures timing, in seconds
+    try:
+        main.settings['long_press_time'] = float(config.get('config',
+            'long_press_time').split("#",1)[0].strip())
+    except:
+        main.settings['long_press_time'] = 0.5
+    try:
+        main.settings['double_tap_time'] = float(config.get('config',
+            'double_tap_time').split("#",1)[0].strip())
+    except:
+        main.settings['double_tap_time'] = 0.3
+
     try:
         main.settings['buttons_notifications'] = config.getboolean('config', 'buttons_notifications')
     except:
@@ -639,6 +1331,27 @@ def read_config():
     except:
         main.settings['scrollbar_reverse'] = False
 
+    # scrollbar output: shortcut (su/sd repeated) or wheel (virtual wheel)
+    try:
+        main.settings['scrollbar_output'] = config.get('config',
+            'scrollbar_output').split("#",1)[0].strip().lower()
+        if main.settings['scrollbar_output'] not in ('shortcut', 'wheel'):
+            main.settings['scrollbar_output'] = 'shortcut'
+    except:
+        main.settings['scrollbar_output'] = 'shortcut'
+
+    # scrollbar acceleration
+    for key, default in (('scroll_sensitivity', 1.0), ('scroll_acceleration', 1.0),
+            ('scroll_threshold', 20.0), ('scroll_max_gain', 4.0),
+            ('scroll_batch_time', 0.05)):
+        try:
+            main.settings[key] = float(config.get('config',
+                key).split("#",1)[0].strip())
+        except:
+            main.settings[key] = default
+    if main.settings['scroll_threshold'] <= 0:
+        main.settings['scroll_threshold'] = 20.0
+
     # scrollbar notifications
     try:
         main.settings['scrollbar_notifications'] = config.getboolean('config', 'scrollbar_notifications')
@@ -660,20 +1373,9 @@ def read_config():
 
     try:
         main.settings['monitor_setup'] = config.get('config', 'current_monitor_setup')
-        current_monitor_setup =  main.settings['monitor_setup'].split("#",1)[0].strip('[]').strip()
-        main.settings['total_screen_width'] = numexpr.evaluate(config.get(current_monitor_setup,
-            'total_screen_width').split("#",1)[0].strip())
-        main.settings['total_screen_height'] = numexpr.evaluate(config.get(current_monitor_setup,
-            'total_screen_height').split("#",1)[0].strip())
-        main.settings['tablet_offset_x'] = numexpr.evaluate(config.get(current_monitor_setup,
-            'tablet_offset_x').split("#",1)[0].strip())
-        main.settings['tablet_offset_y'] = numexpr.evaluate(config.get(current_monitor_setup,
-            'tablet_offset_y').split("#",1)[0].strip())
-
-        main.settings['xrandr_args'] = config.get(current_monitor_setup,
-            'xrandr_args').split("#",1)[0].strip()
+        read_monitor_setup(config, main.settings['monitor_setup'])
     except:
-        current_monitor_setup = "none"
+        pass
 
     # tablet calibration
 
@@ -693,6 +1395,11 @@ def read_config():
     # miscellaneus
 
     main.settings['uclogic_bins'] = config.get('config', 'uclogic_bins')
+    try:
+        main.settings['uclogic_cache'] = os.path.expanduser(config.get('config',
+            'uclogic_cache').split("#",1)[0].strip())
+    except:
+        main.settings['uclogic_cache'] = ''
     try:
         main.settings['enable_notifications'] = config.getboolean('config', 'enable_notifications')
     except:
@@ -703,6 +1410,35 @@ def read_config():
     except:
         main.settings['start_menu'] = ''
 
+    # control socket
+    try:
+        main.settings['enable_control_socket'] = config.getboolean('config', 'enable_control_socket')
+    except:
+        main.settings['enable_control_socket'] = False
+    try:
+        main.settings['control_socket'] = config.get('config',
+            'control_socket').split("#",1)[0].strip()
+    except:
+        main.settings['control_socket'] = '/run/huion-tablet-driver.sock'
+
+    # who can connect: root, the user running sudo, and control_socket_group
+    if os.environ.get('SUDO_UID', '').isdigit():
+        main.settings['control_socket_owner'] = int(os.environ['SUDO_UID'])
+    else:
+        main.settings['control_socket_owner'] = os.getuid()
+    main.settings['control_socket_uids'] = {os.getuid(),
+        main.settings['control_socket_owner']}
+    try:
+        group = config.get('config', 'control_socket_group').split("#",1)[0].strip()
+    except:
+        group = ''
+    try:
+        main.settings['control_socket_gid'] = group and grp.getgrnam(group).gr_gid or None
+    except KeyError:
+        print("\nWarning, unknown control_socket_group {}".format(group),
+            file=sys.stderr)
+        main.settings['control_socket_gid'] = None
+
 
     for section in config.sections():
         if section.startswith('menu_'):
@@ -723,6 +1459,18 @@ def read_config():
                 else:
                     MENU[section][n] = ""
 
+            # gestures: long presses, double taps and chords
+            MENU[section]['gestures'] = {}
+            for option in config.options(section):
+                if re.match(r'b\d+_(long|double)$', option):
+                    key = option
+                elif re.match(r'b\d+(\+b\d+)+$', option):
+                    key = '+'.join('b{}'.format(n) for n in
+                        sorted(set(int(b) for b in option[1:].split('+b'))))
+                else:
+                    continue
+                MENU[section]['gestures'][key] = config.get(section, option).strip()
+
             # scrollbar
             if main.settings['scrollbar']:
                 try:
@@ -739,6 +1487,29 @@ def read_config():
     print("Done!")
 
 
+# -----------------------------------------------------------------------------
+def read_monitor_setup(config, monitor_setup):
+    """ Reads the geometry of a [monitor_*] section into the settings.
+        Returns False and leaves the settings untouched if it's incomplete.
+    """
+    section = monitor_setup.split("#",1)[0].strip().strip('[]').strip()
+    geometry = {}
+
+    try:
+        for key in ('total_screen_width', 'total_screen_height',
+                'tablet_offset_x', 'tablet_offset_y'):
+            geometry[key] = numexpr.evaluate(config.get(section,
+                key).split("#",1)[0].strip())
+        geometry['xrandr_args'] = config.get(section,
+            'xrandr_args').split("#",1)[0].strip()
+    except:
+        return False
+
+    main.settings.update(geometry)
+    main.settings['monitor_setup'] = '[{}]'.format(section)
+    return True
+
+
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
     main.run()